@@ -29,6 +29,9 @@ from capsules.models.scae import ImageCapsule
 flags.DEFINE_float('lr', 1e-4, 'Learning rate.')
 flags.DEFINE_boolean('use_lr_schedule', True, 'Uses learning rate schedule'
                                               ' if True.')
+flags.DEFINE_boolean('mixed_precision', False, 'Runs matmuls and elementwise '
+                                              'ops in float16 using automatic '
+                                              'mixed precision if True.')
 
 flags.DEFINE_integer('template_size', 11, 'Template size.')
 flags.DEFINE_integer('n_part_caps', 16, 'Number of part capsules.')
@@ -61,6 +64,9 @@ flags.DEFINE_float('posterior_within_example_sparsity_weight', 10.,
 flags.DEFINE_float('posterior_between_example_sparsity_weight', 10.,
                    'Loss weight.')
 
+flags.DEFINE_boolean('xla_jit', False, 'Compiles the likelihood and loss '
+                                       'computation with XLA if True.')
+
 
 def get(config):
     """Builds the model."""
@@ -85,6 +91,10 @@ def get(config):
 
     eps = 1e-2 / float(config.batch_size) ** 2
     opt = tf.train.RMSPropOptimizer(config.lr, momentum=.9, epsilon=eps)
+    if config.mixed_precision:
+        # variables and loss reductions stay in float32; the graph rewrite
+        # casts compute-heavy ops and adds dynamic loss scaling
+        opt = tf.train.experimental.enable_mixed_precision_graph_rewrite(opt)
 
     return AttrDict(model=model, opt=opt, lr=config.lr)
 
@@ -166,6 +176,7 @@ def make_scae(config):
         # pylint:disable=line-too-long
         posterior_between_example_sparsity_weight=config.posterior_between_example_sparsity_weight,
         # pylint:disable=line-too-long
+        xla_jit=config.xla_jit,
     )
 
     return model
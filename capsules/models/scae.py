@@ -19,7 +19,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
 import functools
+import inspect
 import sonnet as snt
 import tensorflow as tf
 import tensorflow_probability as tfp
@@ -36,6 +38,26 @@ from capsules.tensor_ops import make_brodcastable
 tfd = tfp.distributions
 
 
+@contextlib.contextmanager
+def _null_scope():
+  yield
+
+
+def _takes_presence(module):
+  """Checks if a module accepts presence as a separate input."""
+  build = getattr(module, '_build', module)
+  try:
+    params = inspect.signature(build).parameters
+  except (TypeError, ValueError):
+    return False
+  return 'presence' in params
+
+
+def _tile_batch(tensor, multiple):
+  """Same as `snt.TileByDim([0], [multiple])`."""
+  return tf.tile(tensor, [multiple] + [1] * (tensor.shape.ndims - 1))
+
+
 class ImageCapsule(snt.AbstractModule):
   """Capsule decoder for constellations."""
 
@@ -66,13 +88,11 @@ class ImageCapsule(snt.AbstractModule):
     Returns:
       A bunch of stuff.
     """
-    batch_size = int(x.shape[0])
-
     capsule = _capsule.CapsuleLayer(self._n_caps, self._n_caps_dims,
                                     self._n_votes, **self._capsule_kwargs)
 
     res = capsule(h)
-    vote_shape = [batch_size, self._n_caps, self._n_votes, 6]
+    vote_shape = [-1, self._n_caps, self._n_votes, 6]
     res.vote = tf.reshape(res.vote[Ellipsis, :-1, :], vote_shape)
 
     votes, scale, vote_presence_prob = res.vote, res.scale, res.vote_presence
@@ -81,9 +101,8 @@ class ImageCapsule(snt.AbstractModule):
     ll_res = likelihood(x, presence)
     res.update(ll_res._asdict())
 
-    caps_presence_prob = tf.reduce_max(
-        tf.reshape(vote_presence_prob,
-                   [batch_size, self._n_caps, self._n_votes]), 2)
+    # vote presence is already [B, n_caps, n_votes]
+    caps_presence_prob = tf.reduce_max(vote_presence_prob, -1)
 
     res.caps_presence_prob = caps_presence_prob
     return res
@@ -119,6 +138,7 @@ class ImageAutoencoder(Model):
       weight_decay=0.,
       feed_templates=True,
       prep='none',
+      xla_jit=False,
   ):
 
     super(ImageAutoencoder, self).__init__()
@@ -147,10 +167,22 @@ class ImageAutoencoder(Model):
     self._posterior_between_example_sparsity_weight = posterior_between_example_sparsity_weight
     self._primary_caps_sparsity_weight = primary_caps_sparsity_weight
     self._weight_decay = weight_decay
+    self._decay_vars = None
     self._feed_templates = feed_templates
+    self._encoder_takes_presence = _takes_presence(encoder)
 
     self._prep = prep
+    self._xla_jit = xla_jit
 
+    # stateless reshaping modules are shared between connections
+    self._flatten_templates = snt.BatchFlatten(2)
+    self._merge_caps_into_batch = snt.MergeDims(0, 2)
+
+  def _jit_scope(self):
+    """Marks ops created in this scope for XLA compilation if requested."""
+    if self._xla_jit:
+      return tf.xla.experimental.jit_scope()
+    return _null_scope()
 
   def _img(self, data, prep='none'):
 
@@ -167,52 +199,49 @@ class ImageAutoencoder(Model):
 
     input_x = self._img(data, False)
     target_x = self._img(data, prep=self._prep)
-    batch_size = int(input_x.shape[0])
+    batch_size = tf.shape(input_x)[0]
 
     primary_caps = self._primary_encoder(input_x)
-    pres = primary_caps.presence
+    pose, pres = primary_caps.pose, primary_caps.presence
 
-    expanded_pres = tf.expand_dims(pres, -1)
-    pose = primary_caps.pose
-    input_pose = tf.concat([pose, 1. - expanded_pres], -1)
+    n_templates = int(primary_caps.pose.shape[1])
+    templates = self._primary_decoder.make_templates(n_templates,
+                                                     primary_caps.feature)
 
-    input_pres = pres
+    # gradient is stopped at the source tensors, and inputs derived from them
+    input_pose, input_pres, inpt_templates = pose, pres, templates
     if self._stop_grad_caps_inpt:
       input_pose = tf.stop_gradient(input_pose)
-      input_pres = tf.stop_gradient(pres)
+      input_pres = tf.stop_gradient(input_pres)
+      inpt_templates = tf.stop_gradient(inpt_templates)
 
     target_pose, target_pres = pose, pres
     if self._stop_grad_caps_target:
       target_pose = tf.stop_gradient(target_pose)
       target_pres = tf.stop_gradient(target_pres)
 
+    input_pose_parts = [input_pose, 1. - tf.expand_dims(input_pres, -1)]
+
     # skip connection from the img to the higher level capsule
     if primary_caps.feature is not None:
-      input_pose = tf.concat([input_pose, primary_caps.feature], -1)
-
-    # try to feed presence as a separate input
-    # and if that works, concatenate templates to poses
-    # this is necessary for set transformer
-    n_templates = int(primary_caps.pose.shape[1])
-    templates = self._primary_decoder.make_templates(n_templates,
-                                                     primary_caps.feature)
-
-    try:
-      if self._feed_templates:
-        inpt_templates = templates
-        if self._stop_grad_caps_inpt:
-          inpt_templates = tf.stop_gradient(inpt_templates)
-
-        if inpt_templates.shape[0] == 1:
-          inpt_templates = snt.TileByDim([0], [batch_size])(inpt_templates)
-        inpt_templates = snt.BatchFlatten(2)(inpt_templates)
-        pose_with_templates = tf.concat([input_pose, inpt_templates], -1)
-      else:
-        pose_with_templates = input_pose
-
-      h = self._encoder(pose_with_templates, input_pres)
-
-    except TypeError:
+      input_pose_parts.append(primary_caps.feature)
+
+    # encoders that take presence as a separate input (e.g. set transformer)
+    # also get templates concatenated to poses
+    if self._encoder_takes_presence and self._feed_templates:
+      # templates shared by all examples are broadcast to the batch size
+      inpt_templates = self._flatten_templates(inpt_templates)
+      if inpt_templates.shape[0] == 1:
+        inpt_templates = tf.broadcast_to(
+            inpt_templates, [batch_size] + inpt_templates.shape[1:].as_list())
+      input_pose_parts.append(inpt_templates)
+
+    # parts are concatenated once, directly into the final encoder input
+    input_pose = tf.concat(input_pose_parts, -1)
+
+    if self._encoder_takes_presence:
+      h = self._encoder(input_pose, input_pres)
+    else:
       h = self._encoder(input_pose)
 
     res = self._decoder(h, target_pose, target_pres)
@@ -254,7 +283,8 @@ class ImageAutoencoder(Model):
         template_feature=primary_caps.feature,
         img_embedding=primary_caps.img_embedding)
 
-    tile = snt.TileByDim([0], [res.vote.shape[1]])
+    n_caps = int(res.vote.shape[1])
+    tile = functools.partial(_tile_batch, multiple=n_caps)
     tiled_presence = tile(primary_caps.presence)
 
     tiled_feature = primary_caps.feature
@@ -264,8 +294,8 @@ class ImageAutoencoder(Model):
     tiled_img_embedding = tile(primary_caps.img_embedding)
 
     res.top_down_per_caps_rec = self._primary_decoder(
-        snt.MergeDims(0, 2)(res.vote),
-        snt.MergeDims(0, 2)(res.vote_presence) * tiled_presence,
+        self._merge_caps_into_batch(res.vote),
+        self._merge_caps_into_batch(res.vote_presence) * tiled_presence,
         template_feature=tiled_feature,
         img_embedding=tiled_img_embedding)
 
@@ -276,27 +306,45 @@ class ImageAutoencoder(Model):
     res.rec_mode = rec.pdf.mode()
     res.rec_mean = rec.pdf.mean()
 
-    res.mse_per_pixel = tf.square(target_x - res.rec_mode)
-    res.mse = math_ops.flat_reduce(res.mse_per_pixel)
-
-    res.rec_ll_per_pixel = rec.pdf.log_prob(target_x)
-    res.rec_ll = math_ops.flat_reduce(res.rec_ll_per_pixel)
-
-    n_points = int(res.posterior_mixing_probs.shape[1])
-    mass_explained_by_capsule = tf.reduce_sum(res.posterior_mixing_probs, 1)
-
-    (res.posterior_within_sparsity_loss,
-     res.posterior_between_sparsity_loss) = _capsule.sparsity_loss(
-         self._posterior_sparsity_loss_type,
-         mass_explained_by_capsule / n_points,
-         num_classes=self._n_classes)
-
-    (res.prior_within_sparsity_loss,
-     res.prior_between_sparsity_loss) = _capsule.sparsity_loss(
-         self._prior_sparsity_loss_type,
-         res.caps_presence_prob,
-         num_classes=self._n_classes,
-         within_example_constant=self._prior_within_example_constant)
+    # the likelihood and sparsity terms are chains of elementwise ops followed
+    # by reductions, which XLA can fuse into a handful of kernels
+    with self._jit_scope():
+      mse_per_pixel = tf.math.squared_difference(target_x, res.rec_mode)
+      res.mse = math_ops.flat_reduce(mse_per_pixel)
+
+      rec_ll_per_pixel = rec.pdf.log_prob(target_x)
+      res.rec_ll = math_ops.flat_reduce(rec_ll_per_pixel)
+
+      # per-pixel maps are only needed for image summaries
+      if self._img_summaries:
+        res.mse_per_pixel = mse_per_pixel
+        res.rec_ll_per_pixel = rec_ll_per_pixel
+
+      n_points = int(res.posterior_mixing_probs.shape[1])
+      mass_explained_by_capsule = tf.reduce_sum(res.posterior_mixing_probs, 1)
+      res.mass_explained_by_capsule = mass_explained_by_capsule
+
+      # sparsity losses are built only if they contribute to the loss
+      res.posterior_within_sparsity_loss = 0.0
+      res.posterior_between_sparsity_loss = 0.0
+      if (self._posterior_within_example_sparsity_weight != 0. or
+          self._posterior_between_example_sparsity_weight != 0.):
+        (res.posterior_within_sparsity_loss,
+         res.posterior_between_sparsity_loss) = _capsule.sparsity_loss(
+             self._posterior_sparsity_loss_type,
+             mass_explained_by_capsule / n_points,
+             num_classes=self._n_classes)
+
+      res.prior_within_sparsity_loss = 0.0
+      res.prior_between_sparsity_loss = 0.0
+      if (self._prior_within_example_sparsity_weight != 0. or
+          self._prior_between_example_sparsity_weight != 0.):
+        (res.prior_within_sparsity_loss,
+         res.prior_between_sparsity_loss) = _capsule.sparsity_loss(
+             self._prior_sparsity_loss_type,
+             res.caps_presence_prob,
+             num_classes=self._n_classes,
+             within_example_constant=self._prior_within_example_constant)
 
     label = self._label(data)
     if label is not None:
@@ -315,39 +363,59 @@ class ImageAutoencoder(Model):
 
     res.primary_caps_l1 = math_ops.flat_reduce(res.primary_presence)
 
-
     if self._weight_decay > 0.0:
-      decay_losses_list = []
-      for var in tf.trainable_variables():
-        if 'w:' in var.name or 'weights:' in var.name:
-          decay_losses_list.append(tf.nn.l2_loss(var))
-      res.weight_decay_loss = tf.reduce_sum(decay_losses_list)
+      res.weight_decay_loss = tf.add_n(
+          [0.] + [tf.nn.l2_loss(var) for var in self._decay_variables()])
     else:
       res.weight_decay_loss = 0.0
 
 
     return res
 
+  def _decay_variables(self):
+    """Returns weight matrices subject to weight decay.
+
+    The selection is done once, after the model variables have been created,
+    and reused every time the model is connected.
+    """
+    if self._decay_vars is None:
+      self._decay_vars = [
+          var for var in tf.trainable_variables()
+          if 'w:' in var.name or 'weights:' in var.name
+      ]
+    return self._decay_vars
+
   def _loss(self, data, res):
 
-    loss = (-res.rec_ll - self._caps_ll_weight * res.log_prob +
-            self._dynamic_l2_weight * res.dynamic_weights_l2 +
-            self._primary_caps_sparsity_weight * res.primary_caps_l1 +
-            self._posterior_within_example_sparsity_weight *
-            res.posterior_within_sparsity_loss -
-            self._posterior_between_example_sparsity_weight *
-            res.posterior_between_sparsity_loss +
-            self._prior_within_example_sparsity_weight *
-            res.prior_within_sparsity_loss -
-            self._prior_between_example_sparsity_weight *
-            res.prior_between_sparsity_loss +
-            self._weight_decay * res.weight_decay_loss
-           )
-
-    try:
-      loss += res.posterior_cls_xe + res.prior_cls_xe
-    except AttributeError:
-      pass
+    with self._jit_scope():
+      weights_and_terms = [
+          (1., -res.rec_ll),
+          (self._caps_ll_weight, -res.log_prob),
+          (self._dynamic_l2_weight, res.dynamic_weights_l2),
+          (self._primary_caps_sparsity_weight, res.primary_caps_l1),
+          (self._posterior_within_example_sparsity_weight,
+           res.posterior_within_sparsity_loss),
+          (self._posterior_between_example_sparsity_weight,
+           -res.posterior_between_sparsity_loss),
+          (self._prior_within_example_sparsity_weight,
+           res.prior_within_sparsity_loss),
+          (self._prior_between_example_sparsity_weight,
+           -res.prior_between_sparsity_loss),
+          (self._weight_decay, res.weight_decay_loss),
+      ]
+
+      # terms with zero weights are not part of the loss
+      weights_and_terms = [(w, t) for w, t in weights_and_terms if w != 0.]
+
+      # weights are python floats, so the weighted sum is a single
+      # elementwise product and reduction over stacked scalars
+      weights, terms = zip(*weights_and_terms)
+      loss = tf.reduce_sum(
+          tf.constant(weights, dtype=tf.float32) *
+          tf.stack([tf.to_float(t) for t in terms]))
+
+      if 'prior_cls_xe' in res:
+        loss += res.posterior_cls_xe + res.prior_cls_xe
 
     return loss
 
@@ -356,13 +424,13 @@ class ImageAutoencoder(Model):
 
     n_caps = self._decoder._n_caps  # pylint:disable=protected-access
 
-    is_from_capsule = res.is_from_capsule
-    ones = tf.ones_like(is_from_capsule)
-    capsule_one_hot = tf.one_hot((is_from_capsule + ones),
-                                 depth=n_caps + 1)[Ellipsis, 1:]
-
-    num_per_group = tf.reduce_sum(capsule_one_hot, 1)
-    num_per_group_per_batch = tf.reduce_mean(tf.to_float(num_per_group), 0)
+    # counting votes over the whole batch and dividing by the batch size is
+    # the same as averaging per-example counts, without building a one-hot
+    is_from_capsule = tf.to_int32(res.is_from_capsule)
+    batch_size = tf.to_float(tf.shape(is_from_capsule)[0])
+    num_per_group = tf.math.bincount(
+        is_from_capsule, minlength=n_caps, maxlength=n_caps, dtype=tf.float32)
+    num_per_group_per_batch = num_per_group / batch_size
 
     reports.update({
         'votes_per_capsule_{}'.format(k): v
@@ -381,40 +449,50 @@ class ImageAutoencoder(Model):
     if label is not None:
       label_one_hot = tf.one_hot(label, depth=self._n_classes)
 
+    # only the first few examples are shown, so we render just these; label
+    # correlations below still use the whole batch
+    n_examples = min(int(img.shape[0]), 16)
+
+    def first(tensor):
+      return tensor[:n_examples]
+
+    img = first(img)
+
     _render_activations = functools.partial(  # pylint:disable=invalid-name
         plot.render_activations,
         height=int(img.shape[1]),
         pixels_per_caps=3,
         cmap='viridis')
 
-    mass_explained_by_capsule = tf.reduce_sum(res.posterior_mixing_probs, 1)
+    mass_explained_by_capsule = res.mass_explained_by_capsule
     normalized_mass_expplained_by_capsule = mass_explained_by_capsule / tf.reduce_max(
         mass_explained_by_capsule, -1, keepdims=True)  # pylint:disable=line-too-long
 
     posterior_caps_activation = _render_activations(
-        normalized_mass_expplained_by_capsule)  # pylint:disable=line-too-long
-    prior_caps_activation = _render_activations(res.caps_presence_prob)
+        first(normalized_mass_expplained_by_capsule))  # pylint:disable=line-too-long
+    prior_caps_activation = _render_activations(first(res.caps_presence_prob))
 
     is_from_capsule = snt.BatchApply(_render_activations)(
-        res.posterior_mixing_probs)
+        first(res.posterior_mixing_probs))
 
     green = res.top_down_rec
-    rec_red = res.rec_mode
-    rec_green = green.pdf.mode()
+    rec_red = first(res.rec_mode)
+    rec_green = first(green.pdf.mode())
 
     flat_per_caps_rec = res.top_down_per_caps_rec.pdf.mode()
     shape = res.vote.shape[:2].concatenate(flat_per_caps_rec.shape[1:])
-    per_caps_rec = tf.reshape(flat_per_caps_rec, shape)
+    per_caps_rec = first(tf.reshape(flat_per_caps_rec, shape))
     per_caps_rec = plot.concat_images(
         tf.unstack(per_caps_rec, axis=1), 1, vertical=False)
     one_image = tf.reduce_mean(
-        self._img(data, self._prep), axis=-1, keepdims=True)
+        first(self._img(data, self._prep)), axis=-1, keepdims=True)
     one_rec = tf.reduce_mean(rec_red, axis=-1, keepdims=True)
     diff = tf.concat([one_image, one_rec, tf.zeros_like(one_image)], -1)
 
-    used_templates = tf.reduce_mean(res.used_templates, axis=-1, keepdims=True)
+    used_templates = tf.reduce_mean(
+        first(res.used_templates), axis=-1, keepdims=True)
     green_templates = tf.reduce_mean(
-        green.transformed_templates, axis=-1, keepdims=True)
+        first(green.transformed_templates), axis=-1, keepdims=True)
     templates = tf.concat(
         [used_templates, green_templates,
          tf.zeros_like(used_templates)], -1)
@@ -435,24 +513,28 @@ class ImageAutoencoder(Model):
 
     img_with_templates = plot.concat_images(all_imgs, 1, vertical=False)
 
-    def render_corr(x, y):
-      corr = abs(plot.correlation(x, y))
-      rendered_corr = tf.expand_dims(_render_activations(corr), 0)
+    def render_corr(corr):
+      rendered_corr = tf.expand_dims(_render_activations(abs(corr)), 0)
       return plot.concat_images(
           tf.unstack(rendered_corr, axis=1), 3, vertical=False)
 
     if label is not None:
 
-      posterior_label_corr = render_corr(normalized_mass_expplained_by_capsule,
-                                         label_one_hot)
-      prior_label_corr = render_corr(res.caps_presence_prob, label_one_hot)
+      # correlation is pairwise, so both capsule activations can share
+      # a single correlation matrix with labels
+      n_caps = int(res.caps_presence_prob.shape[-1])
+      caps_label_corr = plot.correlation(
+          tf.concat([normalized_mass_expplained_by_capsule,
+                     res.caps_presence_prob], -1), label_one_hot)
+
+      posterior_label_corr = render_corr(caps_label_corr[:n_caps])
+      prior_label_corr = render_corr(caps_label_corr[n_caps:])
       label_corr = plot.concat_images([prior_label_corr, posterior_label_corr],
                                       3,
                                       vertical=True)
     else:
       label_corr = tf.zeros_like(img)
 
-    n_examples = min(int(shape[0]), 16)
     plot_params = dict(
         img_with_templates=dict(
             grid_height=n_examples,
@@ -472,7 +554,7 @@ class ImageAutoencoder(Model):
 
     plot_dict = dict(
         templates=templates,
-        img_with_templates=img_with_templates[:n_examples],
+        img_with_templates=img_with_templates,
         label_corr=label_corr,
     )
 
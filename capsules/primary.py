@@ -127,6 +127,7 @@ class TemplateBasedImageDecoder(snt.AbstractModule):
     """Template-based primary capsule decoder for images."""
 
     _templates = None
+    _raw_templates = None
 
     def __init__(self,
                  output_size,
@@ -154,7 +155,7 @@ class TemplateBasedImageDecoder(snt.AbstractModule):
     @property
     def templates(self):
         self._ensure_is_connected()
-        return tf.squeeze(self._templates, 0)
+        return self._raw_templates
 
     @snt.reuse_variables
     def make_templates(self, n_templates=None, template_feature=None):
@@ -184,6 +185,9 @@ class TemplateBasedImageDecoder(snt.AbstractModule):
                 # prevent negative ink
                 self._template_logits = template_logits
                 self._templates = self._template_nonlin(template_logits)
+                # templates do not depend on the input, so they are built once
+                # per graph and shared by every connection of the module
+                self._raw_templates = tf.squeeze(self._templates, 0)
 
                 if self._use_alpha_channel:
                     self._templates_alpha = tf.get_variable(
@@ -291,7 +295,7 @@ class TemplateBasedImageDecoder(snt.AbstractModule):
             raise ValueError('Unknown pdf type: "{}".'.format(self._output_pdf_type))
 
         return AttrDict(
-            raw_templates=tf.squeeze(self._templates, 0),
+            raw_templates=self._raw_templates,
             transformed_templates=transformed_templates[:, :-1],
             mixing_logits=template_mixing_logits[:, :-1],
             pdf=rec_pdf)